@@ -1,16 +1,114 @@
-import tweepy
+import itertools
+import logging
+import threading
+import time
+import traceback
+
+# Time before retrying to get the bearer token of an app after a failure
+APP_TOKEN_RETRY_PERIOD = 60
+
+
+def load_tweepy():
+    """
+    Import tweepy on first use, so it's not loaded before connecting to
+    PrograMaker.
+    """
+    import tweepy
+
+    return tweepy
 
 
 class AuthHandler:
-    def __init__(self, config, storage):
+    def __init__(self, config, storage, rate_limit_manager=None):
         self.config = config
         self.storage = storage
+        self.rate_limit_manager = rate_limit_manager
+        self.apps = config.get_twitter_apps()
+        self.app_cycle = itertools.cycle(range(len(self.apps)))
+        self.app_cycle_lock = threading.Lock()
+        self.app_apis = {}
+        self.app_token_failures = {}  # App index -> time of the last failure
+        self.app_apis_lock = threading.Lock()
 
-    def get_api(self, connection_id):
+    def assign_app(self):
+        """
+        Choose the app a new user will be registered with.
+        """
+        with self.app_cycle_lock:
+            return next(self.app_cycle)
+
+    def get_oauth_handler(self, app_index, callback_url=None):
+        tweepy = load_tweepy()
+        token, token_secret = self.apps[app_index]
+        return tweepy.OAuthHandler(token, token_secret, callback_url)
+
+    def get_api(self, connection_id, raw_json=False):
+        tweepy = load_tweepy()
         access_data = self.storage.get_consumer_key(connection_id)[0]
 
-        auth = tweepy.OAuthHandler(
-            self.config.get_twitter_token(), self.config.get_twitter_token_secret()
-        )
+        auth = self.get_oauth_handler(access_data["app"])
         auth.set_access_token(access_data["token"], access_data["token_secret"])
+        if raw_json:
+            # Skip building tweepy models for data sent as-is to the platform
+            return tweepy.API(auth, parser=tweepy.parsers.JSONParser())
         return tweepy.API(auth)
+
+    def get_app_api(self, endpoint):
+        """
+        Get an app-only (bearer token) API, on the app with the most calls left
+        for `endpoint`. Returns None if none of the apps has calls left, or if
+        the bearer token can't be obtained.
+
+        These APIs parse responses as raw JSON, and can only read public data.
+        """
+        now = time.time()
+        with self.app_apis_lock:
+            # Apps whose bearer token failed recently are skipped for a while
+            app_indexes = [
+                app_index
+                for app_index in range(len(self.apps))
+                if app_index in self.app_apis
+                or now - self.app_token_failures.get(app_index, 0)
+                > APP_TOKEN_RETRY_PERIOD
+            ]
+
+        app_index = self.rate_limit_manager.choose_app(app_indexes, endpoint)
+        if app_index is None:
+            return None
+
+        api = self._get_bearer_api(app_index)
+        if api is None:
+            return None
+
+        # The call is only accounted once there's an API to do it
+        if self.rate_limit_manager.reserve_app_call([app_index], endpoint) is None:
+            return None
+        return api
+
+    def _get_bearer_api(self, app_index):
+        with self.app_apis_lock:
+            api = self.app_apis.get(app_index, None)
+        if api is not None:
+            return api
+
+        tweepy = load_tweepy()
+        token, token_secret = self.apps[app_index]
+        try:
+            # This requests the bearer token to Twitter, so it's done without
+            # holding the lock.
+            handler = tweepy.AppAuthHandler(token, token_secret)
+        except Exception:
+            logging.error(
+                "Getting bearer token for app {app} \n{error}".format(
+                    app=app_index, error=traceback.format_exc()
+                )
+            )
+            with self.app_apis_lock:
+                self.app_token_failures[app_index] = time.time()
+            return None
+
+        api = tweepy.API(handler, parser=tweepy.parsers.JSONParser())
+        with self.app_apis_lock:
+            self.app_token_failures.pop(app_index, None)
+            # Another thread might have got it meanwhile, keep a single one
+            return self.app_apis.setdefault(app_index, api)
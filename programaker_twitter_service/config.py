@@ -7,11 +7,13 @@ from xdg import XDG_CONFIG_HOME
 BRIDGE_ENDPOINT_ENV = "PLAZA_BRIDGE_ENDPOINT"
 TWITTER_CONSUMER_API_TOKEN_ENV = "TWITTER_CONSUMER_API_TOKEN"
 TWITTER_CONSUMER_API_TOKEN_SECRET_ENV = "TWITTER_CONSUMER_API_TOKEN_SECRET"
+TWITTER_CONSUMER_APPS_ENV = "TWITTER_CONSUMER_APPS"
 AUTH_TOKEN_ENV = "PLAZA_BRIDGE_AUTH_TOKEN"
 
 BRIDGE_ENDPOINT_INDEX = "plaza_bridge_endpoint"
 TWITTER_CONSUMER_API_TOKEN_INDEX = "twitter_consumer_api_token"
 TWITTER_CONSUMER_API_TOKEN_SECRET_INDEX = "twitter_consumer_api_token_secret"
+TWITTER_CONSUMER_APPS_INDEX = "twitter_consumer_apps"
 AUTH_TOKEN_INDEX = "plaza_authentication_token"
 
 global directory, config_file
@@ -82,6 +84,29 @@ def get_twitter_token_secret():
     return config[TWITTER_CONSUMER_API_TOKEN_SECRET_INDEX]
 
 
+def get_twitter_apps():
+    """
+    Returns the list of (token, token_secret) pairs for the Twitter apps.
+
+    The first one is always the app from `get_twitter_token` and
+    `get_twitter_token_secret`, any additional one is read from a JSON list
+    of `{"token": ..., "token_secret": ...}` objects.
+    """
+    apps = [(get_twitter_token(), get_twitter_token_secret())]
+
+    # Additional apps are optional, so they are not requested if not found
+    apps_env = os.getenv(TWITTER_CONSUMER_APPS_ENV, None)
+    if apps_env is not None:
+        extra_apps = json.loads(apps_env)
+    else:
+        extra_apps = _get_config().get(TWITTER_CONSUMER_APPS_INDEX, [])
+
+    for app in extra_apps:
+        apps.append((app["token"], app["token_secret"]))
+
+    return apps
+
+
 def get_auth_token():
     env_val = os.getenv(AUTH_TOKEN_ENV, None)
     if env_val is not None:
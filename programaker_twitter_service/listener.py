@@ -1,12 +1,50 @@
 import logging
 import os
+import sys
 import threading
 import time
 import traceback
 
 from . import rate_limit
+from .auth import load_tweepy
+from .tweet_cache import TweetCache
 
 NUM_TWEETS_PER_CHECK = 10  # How many tweets are retrieved in a single check
+USER_LOAD_CHUNK_SIZE = 1000  # How many users are loaded on each loop iteration
+# Rate limit records which were not updated in this time are dropped
+STALE_USAGE_AGE = 24 * rate_limit.HOURS
+STALE_EVICTION_PERIOD = 10 * rate_limit.MINUTES
+# Users registered from outside of this process (by `import-tokens`) are picked
+# up from their pending follower syncs this often.
+PENDING_SYNC_RELOAD_PERIOD = 1 * rate_limit.MINUTES
+# A full follower list comparison is done at least this often, even if the
+# follower count didn't change (to catch a follow and unfollow in between).
+FULL_FOLLOWER_CHECK_PERIOD = 1 * rate_limit.HOURS
+# Channels that couldn't be read with app-only tokens are tried again after this
+PRIVATE_CHANNEL_RECHECK_PERIOD = 6 * rate_limit.HOURS
+# Twitter error codes for timelines which the app-only tokens can't read
+# (179: protected account, 136: blocked).
+PRIVATE_TIMELINE_ERROR_CODES = (179, 136)
+
+
+def is_private_timeline_error(error):
+    """
+    Tell if a `TweepError` means the timeline is not public, as opposed to
+    transient failures (rate limits, server errors, timeouts...).
+    """
+    response = getattr(error, "response", None)
+    if response is not None and response.status_code == 401:
+        return True
+    return getattr(error, "api_code", None) in PRIVATE_TIMELINE_ERROR_CODES
+
+
+class FollowerState:
+    __slots__ = ("count", "changed", "last_full_check")
+
+    def __init__(self):
+        self.count = None
+        self.changed = True  # Not known yet, so do a full check first
+        self.last_full_check = None
 
 
 class TweetListenerThread(threading.Thread):
@@ -14,26 +52,40 @@ class TweetListenerThread(threading.Thread):
         threading.Thread.__init__(self)
         self.bot = bot
         self.rate_limit_manager = rate_limit_manager
+        # User -> tuple of interned screen names. Tuples are much smaller than
+        # sets for the few channels each user usually listens to.
         self.by_user = {}
-        self.to_check = {}
         self.timelines = set()
-        self.users = set(storage.get_all_users())
+        self.users = set()
+        self.storage = storage
+        self.pending_user_chunks = None
+        self.last_eviction = time.time()
+        self.last_pending_sync_reload = None
+        self.follower_states = {}
+        # Users which were just registered, their followers have to be loaded
+        # without triggering follow events.
+        self.pending_follower_syncs = set()
 
     def start(self):
         threading.Thread.start(self)
 
     def add_to_user(self, user, subkey):
         logging.debug("New listener: {} {}".format(user, subkey))
-        if user not in self.by_user:
-            self.by_user[user] = set()
-        self.by_user[user].add(subkey)
+        user = sys.intern(user)
+        subkey = sys.intern(subkey)
+        channels = self.by_user.get(user, ())
+        if subkey not in channels:
+            self.by_user[user] = channels + (subkey,)
 
     def add_home_timeline(self, user):
         logging.debug("New home timeline: {}".format(user))
-        self.timelines.add(user)
+        self.timelines.add(sys.intern(user))
 
-    def add_new_user(self, user):
+    def add_new_user(self, user, needs_follower_sync=False):
         logging.debug("New user: {}".format(user))
+        user = sys.intern(user)
+        if needs_follower_sync:
+            self.pending_follower_syncs.add(user)
         self.users.add(user)
 
     def run(self):
@@ -45,25 +97,103 @@ class TweetListenerThread(threading.Thread):
         # Stop the bridge immediately if this is done *for whatever reason*
         os._exit(1)
 
+    def load_next_users_chunk(self):
+        # Users are streamed in chunks while the loop is already running,
+        # instead of materializing all of them before starting.
+        if self.pending_user_chunks is None:
+            return
+
+        start = time.time()
+        chunk = next(self.pending_user_chunks, None)
+        if chunk is None:
+            self.pending_user_chunks = None
+            logging.info("All {} users loaded".format(len(self.users)))
+            return
+
+        self.users.update(map(sys.intern, chunk))
+        logging.debug(
+            "Loaded {} users in {:.3f}s".format(len(chunk), time.time() - start)
+        )
+
+    def reload_pending_follower_syncs(self):
+        if (
+            self.last_pending_sync_reload is not None
+            and time.time() - self.last_pending_sync_reload < PENDING_SYNC_RELOAD_PERIOD
+        ):
+            return
+        self.last_pending_sync_reload = time.time()
+
+        # All new registrations have a pending sync, so this also finds the
+        # users imported while the bridge is running.
+        for user in self.storage.get_pending_follower_syncs():
+            user = sys.intern(user)
+            if user not in self.pending_follower_syncs:
+                self.pending_follower_syncs.add(user)
+                self.users.add(user)
+
     def inner_loop(self):
+        self.pending_user_chunks = self.storage.iter_user_chunks(USER_LOAD_CHUNK_SIZE)
         while 1:
+            self.reload_pending_follower_syncs()
+            self.load_next_users_chunk()
             self.check_all_followers()
             self.check_all_timelines()
             self.check_all_monitors()
+            self.evict_stale_usage()
             time.sleep(1)
 
+    def evict_stale_usage(self):
+        if time.time() - self.last_eviction < STALE_EVICTION_PERIOD:
+            return
+        self.last_eviction = time.time()
+        self.rate_limit_manager.evict_stale(STALE_USAGE_AGE)
+        self.bot.evict_expired_private_channels()
+
     def check_all_followers(self):
-        for user_id in self.users:
-            if self.rate_limit_manager.time_for_periodic_check(
-                user_id, rate_limit.FOLLOWERS_IDS, 1
-            ):
-                try:
+        # Copy the users, as new ones can be added from the registration thread
+        for user_id in list(self.users):
+            try:
+                if self.followers_may_have_changed(
+                    user_id
+                ) and self.rate_limit_manager.time_for_periodic_check(
+                    user_id, rate_limit.FOLLOWERS_IDS, 1
+                ):
                     self.check_followers(user_id)
-                except Exception:
-                    logging.error(traceback.format_exc())
+            except Exception:
+                logging.error(traceback.format_exc())
+
+    def followers_may_have_changed(self, user_id):
+        # The follower count is much cheaper (in rate limit) to get than the
+        # follower list, so the list is only pulled when the count changes.
+        state = self.follower_states.get(user_id, None)
+        if state is None:
+            state = self.follower_states[user_id] = FollowerState()
+
+        if state.changed:
+            return True
+
+        if time.time() - state.last_full_check > FULL_FOLLOWER_CHECK_PERIOD:
+            return True
+
+        if not self.rate_limit_manager.time_for_periodic_check(
+            user_id, rate_limit.VERIFY_CREDENTIALS, 1
+        ):
+            return False
+
+        count = self.bot.get_followers_count(user_id)
+        if count != state.count:
+            logging.debug(
+                "Follower count change for {}: {} -> {}".format(
+                    user_id, state.count, count
+                )
+            )
+            state.count = count
+            state.changed = True
+
+        return state.changed
 
     def check_all_timelines(self):
-        for user_id in self.timelines:
+        for user_id in list(self.timelines):
             if self.rate_limit_manager.time_for_periodic_check(
                 user_id, rate_limit.HOME_TIMELINE, 1
             ):
@@ -73,7 +203,7 @@ class TweetListenerThread(threading.Thread):
                     logging.error(traceback.format_exc())
 
     def check_all_monitors(self):
-        for user_id, user_channels in self.by_user.items():
+        for user_id, user_channels in list(self.by_user.items()):
             for channel in user_channels:
                 if self.rate_limit_manager.time_for_periodic_check(
                     user_id, rate_limit.USER_TIMELINE, len(user_channels), channel,
@@ -99,14 +229,29 @@ class TweetListenerThread(threading.Thread):
 
     def check_followers(self, user_id):
         logging.debug("Checking follower update for {}".format(user_id))
-        self.bot.check_followers(user_id)
+        needs_sync = user_id in self.pending_follower_syncs
+        count = self.bot.check_followers(user_id, needs_sync)
+        self.pending_follower_syncs.discard(user_id)
+
+        state = self.follower_states[user_id]
+        if state.count is None:
+            # Later counts are compared with the ones from verify_credentials
+            state.count = count
+        state.changed = False
+        state.last_full_check = time.time()
 
 
 class TweetListener:
-    def __init__(self, api_dispatcher, storage, rate_limit_manager):
+    def __init__(self, api_dispatcher, storage, rate_limit_manager, tweet_cache=None):
         self.api_dispatcher = api_dispatcher
         self.thread = TweetListenerThread(self, rate_limit_manager, storage)
         self.storage = storage
+        if tweet_cache is None:
+            tweet_cache = TweetCache()
+        self.tweet_cache = tweet_cache
+        # Channels which can't be read with app-only tokens (protected ones)
+        # -> time when they were found to be so.
+        self.private_channels = {}
 
     def add_to_user(self, user, subkey):
         self.thread.add_to_user(user, subkey)
@@ -114,37 +259,79 @@ class TweetListener:
     def add_home_timeline(self, user):
         self.thread.add_home_timeline(user)
 
-    def add_new_user(self, user):
-        self.thread.add_new_user(user)
+    def add_new_user(self, user, needs_follower_sync=False):
+        self.thread.add_new_user(user, needs_follower_sync)
 
     def check(self, user_id, channel):
-        tweets = self.api_dispatcher.get_api(user_id).user_timeline(
-            screen_name=channel, count=NUM_TWEETS_PER_CHECK
-        )
+        tweets = None
+        if not self.is_private_channel(channel):
+            tweets = self.get_public_timeline(channel)
+
+        public = tweets is not None
+        if tweets is None:
+            tweets = self.api_dispatcher.get_api(user_id, raw_json=True).user_timeline(
+                screen_name=channel, count=NUM_TWEETS_PER_CHECK
+            )
+        tweets = self.tweet_cache.add_timeline(channel, tweets, public=public)
         last_tweet_by_user = self.storage.get_last_tweet_by_user(user_id, channel) or 0
         for tweet in tweets[::-1]:
-            tweet_id = tweet._json["id"]
+            tweet_id = tweet["id"]
             if tweet_id > last_tweet_by_user:
                 self.storage.set_last_tweet_by_user(user_id, channel, tweet_id)
                 self.on_update(user_id, tweet)
 
+    def get_public_timeline(self, channel):
+        # Public timelines are read with the app tokens, spread across the pool
+        api = self.api_dispatcher.get_app_api(rate_limit.USER_TIMELINE)
+        if api is None:
+            return None
+
+        try:
+            return api.user_timeline(screen_name=channel, count=NUM_TWEETS_PER_CHECK)
+        except load_tweepy().error.TweepError as e:
+            logging.debug("App-only read failed for {}: {}".format(channel, e))
+            if is_private_timeline_error(e):
+                # Protected accounts can only be read by their followers
+                self.private_channels[channel] = time.time()
+            return None
+
+    def is_private_channel(self, channel):
+        marked = self.private_channels.get(channel, None)
+        if marked is None:
+            return False
+        return time.time() - marked < PRIVATE_CHANNEL_RECHECK_PERIOD
+
+    def evict_expired_private_channels(self):
+        limit = time.time() - PRIVATE_CHANNEL_RECHECK_PERIOD
+        for channel, marked in list(self.private_channels.items()):
+            if marked < limit:
+                del self.private_channels[channel]
+
     def check_timeline(self, user_id):
         last_timeline_tweet_id = (
             self.storage.get_last_timeline_tweet_by_user(user_id) or None
         )
-        tweets = self.api_dispatcher.get_api(user_id).home_timeline(
+        tweets = self.api_dispatcher.get_api(user_id, raw_json=True).home_timeline(
             since_id=last_timeline_tweet_id
         )
+        # Home timelines are read with the user's tokens, and carry fields
+        # which depend on the reader, so they are not shared on the cache.
         for tweet in tweets[::-1]:
-            tweet_id = tweet._json["id"]
+            tweet_id = tweet["id"]
             self.storage.set_last_timeline_tweet_by_user(user_id, tweet_id)
             self.on_timeline_update(user_id, tweet)
 
-    def check_followers(self, user_id):
+    def check_followers(self, user_id, needs_sync=False):
         twitter_user_id = self.storage.get_twitter_user_id(user_id)
 
         api = self.api_dispatcher.get_api(user_id)
         new_followers = set(api.followers_ids(screen_name=api.auth.get_username()))
+
+        if needs_sync:
+            # First check after registration, just record the current followers
+            self.storage.initialize_followers(twitter_user_id, new_followers)
+            return len(new_followers)
+
         old_followers = set(self.storage.get_followers(twitter_user_id))
 
         for follower in new_followers:
@@ -157,6 +344,12 @@ class TweetListener:
                 self.on_new_unfollow(user_id, follower)
                 self.storage.remove_follower(twitter_user_id, follower)
 
+        return len(new_followers)
+
+    def get_followers_count(self, user_id):
+        api = self.api_dispatcher.get_api(user_id, raw_json=True)
+        return api.verify_credentials()["followers_count"]
+
     def start(self):
         self.thread.start()
 
@@ -64,3 +64,26 @@ LastTweetInUserTimeline = Table(
     Column("listener_id", String(36), ForeignKey("PLAZA_USERS.id"), primary_key=True),
     Column("tweet_id", BigInteger),
 )
+
+PendingFollowerSync = Table(
+    "PENDING_FOLLOWER_SYNC",
+    metadata,
+    Column(
+        "twitter_id",
+        Integer,
+        ForeignKey("TWITTER_USER_REGISTRATION.id"),
+        primary_key=True,
+    ),
+)
+
+TwitterUserApp = Table(
+    "TWITTER_USER_APP",
+    metadata,
+    Column(
+        "twitter_id",
+        Integer,
+        ForeignKey("TWITTER_USER_REGISTRATION.id"),
+        primary_key=True,
+    ),
+    Column("app_index", Integer),  # Users without an entry belong to app 0
+)
@@ -1,4 +1,5 @@
 import logging
+import threading
 import time
 
 # Information from https://developer.twitter.com/en/docs/basics/rate-limits
@@ -21,6 +22,7 @@ HOME_TIMELINE = "statuses/home_timeline"
 FOLLOW = "friendships/create"
 FOLLOWERS_IDS = "followers/ids"
 USER_INFO = "users/show"
+VERIFY_CREDENTIALS = "account/verify_credentials"
 
 ENDPOINTS = {
     # POST
@@ -72,7 +74,11 @@ ENDPOINTS = {
     "statuses/retweets/:id": {"limit_window": 15 * MINUTES, "per_user_limit": 75},
     "statuses/show/:id": {"limit_window": 15 * MINUTES, "per_user_limit": 900},
     "statuses/home_timeline": {"limit_window": 15 * MINUTES, "per_user_limit": 15},
-    "statuses/user_timeline": {"limit_window": 15 * MINUTES, "per_user_limit": 900},
+    "statuses/user_timeline": {
+        "limit_window": 15 * MINUTES,
+        "per_user_limit": 900,
+        "per_app_limit": 1500,
+    },
     "trends/available": {"limit_window": 15 * MINUTES, "per_user_limit": 75},
     "trends/closest": {"limit_window": 15 * MINUTES, "per_user_limit": 75},
     "trends/place": {"limit_window": 15 * MINUTES, "per_user_limit": 75},
@@ -88,18 +94,143 @@ ENDPOINTS = {
 }
 
 
+class EndpointUsage:
+    """
+    Usage record for a connection on an endpoint.
+
+    Checks without a queried element (the common case) are kept on
+    `last_check`, the per-element dictionary is only created when needed.
+    """
+
+    __slots__ = ("active", "last_check", "element_checks")
+
+    def __init__(self):
+        self.active = None
+        self.last_check = None
+        self.element_checks = None
+
+    def get_check(self, queried_element):
+        if queried_element is None:
+            return self.last_check
+        if self.element_checks is None:
+            return None
+        return self.element_checks.get(queried_element, None)
+
+    def set_check(self, queried_element, timestamp):
+        if queried_element is None:
+            self.last_check = timestamp
+        else:
+            if self.element_checks is None:
+                self.element_checks = {}
+            self.element_checks[queried_element] = timestamp
+
+    def evict_older_than(self, limit):
+        if self.active is not None and self.active < limit:
+            self.active = None
+        if self.last_check is not None and self.last_check < limit:
+            self.last_check = None
+        if self.element_checks is not None:
+            for element, timestamp in list(self.element_checks.items()):
+                if timestamp < limit:
+                    del self.element_checks[element]
+            if len(self.element_checks) == 0:
+                self.element_checks = None
+
+    def is_empty(self):
+        return (
+            self.active is None
+            and self.last_check is None
+            and self.element_checks is None
+        )
+
+
+class AppUsage:
+    """
+    Calls done with an app-only (bearer) token on the current limit window.
+    """
+
+    __slots__ = ("window_start", "calls")
+
+    def __init__(self):
+        self.window_start = time.time()
+        self.calls = 0
+
+
 class RateLimitManager:
     def __init__(self):
         self.usage_info = {}
+        # Usage records are read from the handler threads and evicted from
+        # the listener thread.
+        self.usage_lock = threading.Lock()
+        self.app_usage = {}  # (App index, endpoint) -> AppUsage
+        self.app_usage_lock = threading.Lock()
+
+    def _get_app_usage(self, app_index, endpoint):
+        usage = self.app_usage.get((app_index, endpoint), None)
+        if usage is None:
+            usage = self.app_usage[(app_index, endpoint)] = AppUsage()
+        elif time.time() - usage.window_start > ENDPOINTS[endpoint]["limit_window"]:
+            usage.window_start = time.time()
+            usage.calls = 0
+        return usage
+
+    def _choose_app(self, app_indexes, endpoint):
+        best, best_remaining = None, 0
+        for app_index in app_indexes:
+            usage = self._get_app_usage(app_index, endpoint)
+            remaining = ENDPOINTS[endpoint]["per_app_limit"] - usage.calls
+            if remaining > best_remaining:
+                best, best_remaining = app_index, remaining
+        return best
+
+    def choose_app(self, app_indexes, endpoint):
+        """
+        Pick the app with the most calls left for `endpoint`, without
+        accounting any call. Returns None if all of them have exhausted their
+        limit.
+        """
+        with self.app_usage_lock:
+            return self._choose_app(app_indexes, endpoint)
+
+    def reserve_app_call(self, app_indexes, endpoint):
+        """
+        Pick the app with the most calls left for `endpoint` and account one
+        call on it. Returns None if all of them have exhausted their limit.
+        """
+        with self.app_usage_lock:
+            best = self._choose_app(app_indexes, endpoint)
+            if best is not None:
+                self.app_usage[(best, endpoint)].calls += 1
+            return best
+
+    def _get_usage(self, connection_id, endpoint):
+        with self.usage_lock:
+            connection_usage = self.usage_info.setdefault(connection_id, {})
+            usage = connection_usage.get(endpoint, None)
+            if usage is None:
+                usage = connection_usage[endpoint] = EndpointUsage()
+            return usage
 
     def notify_will_use(self, connection_id, endpoint):
-        if connection_id not in self.usage_info:
-            self.usage_info[connection_id] = {}
+        self._get_usage(connection_id, endpoint).active = time.time()
 
-        if endpoint not in self.usage_info[connection_id]:
-            self.usage_info[connection_id][endpoint] = {"active": None, "check": {}}
+    def evict_stale(self, max_age):
+        """
+        Drop the usage records which have not been touched in `max_age` seconds.
 
-        self.usage_info[connection_id][endpoint]["active"] = time.time()
+        A forgotten check is considered due, same as a check older than its
+        update period, so this doesn't change when checks are performed as
+        long as `max_age` is above the update periods.
+        """
+        limit = time.time() - max_age
+        with self.usage_lock:
+            for connection_id, connection_usage in list(self.usage_info.items()):
+                for endpoint, usage in list(connection_usage.items()):
+                    usage.evict_older_than(limit)
+                    if usage.is_empty():
+                        del connection_usage[endpoint]
+                if len(connection_usage) == 0:
+                    del self.usage_info[connection_id]
 
     def time_for_periodic_check(
         self, connection_id, endpoint, queries_in_bucket, queried_element=None
@@ -122,15 +253,8 @@ class RateLimitManager:
             )
         )
 
-        if connection_id not in self.usage_info:
-            self.usage_info[connection_id] = {}
-
-        if endpoint not in self.usage_info[connection_id]:
-            self.usage_info[connection_id][endpoint] = {"active": None, "check": {}}
-
-        last_time_checked = self.usage_info[connection_id][endpoint]["check"].get(
-            queried_element, None
-        )
+        usage = self._get_usage(connection_id, endpoint)
+        last_time_checked = usage.get_check(queried_element)
 
         time_to_update = False
         if last_time_checked is None:
@@ -154,8 +278,6 @@ class RateLimitManager:
             logging.info("UPDATING")
 
         if time_to_update:
-            self.usage_info[connection_id][endpoint]["check"][
-                queried_element
-            ] = time.time()
+            usage.set_check(queried_element, time.time())
 
         return time_to_update
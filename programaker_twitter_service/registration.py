@@ -0,0 +1,127 @@
+import concurrent.futures
+import logging
+import traceback
+
+from .auth import load_tweepy
+
+BULK_IMPORT_CHUNK_SIZE = 500  # How many token pairs are registered per transaction
+REGISTRATION_TIMEOUT = 60  # Seconds the OAuth return waits for its registration
+REGISTRATION_WORKERS = 8  # Registrations completed in parallel
+
+
+class RegistrationPipeline:
+    """
+    Completes OAuth registrations on a bounded pool of worker threads, so a
+    burst of sign-ups is processed in parallel without an unbounded number of
+    threads talking to Twitter.
+
+    `enqueue` returns a future, so the caller can wait for the outcome and
+    report it back to PrograMaker.
+    """
+
+    def __init__(
+        self,
+        auth_handler,
+        storage,
+        listener,
+        on_registered,
+        workers=REGISTRATION_WORKERS,
+    ):
+        self.auth_handler = auth_handler
+        self.storage = storage
+        self.listener = listener
+        self.on_registered = on_registered
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="registration"
+        )
+
+    def enqueue(self, connection_id, app_index, request_token, verifier):
+        return self.executor.submit(
+            self.run_registration, connection_id, app_index, request_token, verifier
+        )
+
+    def run_registration(self, connection_id, app_index, request_token, verifier):
+        try:
+            self.register(connection_id, app_index, request_token, verifier)
+        except Exception:
+            logging.error(
+                "Registering connection {connection} \n{error}".format(
+                    connection=connection_id, error=traceback.format_exc(),
+                )
+            )
+            raise
+        return True
+
+    def register(self, connection_id, app_index, request_token, verifier):
+        tweepy = load_tweepy()
+        auth = self.auth_handler.get_oauth_handler(app_index)
+        auth.request_token = request_token
+        auth.get_access_token(verifier)
+
+        user = tweepy.API(auth).me()
+        is_new = self.storage.register_user(
+            connection_id, (auth.access_token, auth.access_token_secret), app_index
+        )
+
+        logging.info(
+            "(new={}) Connection {} is registered with: {} (app {})".format(
+                is_new, connection_id, auth.access_token, app_index,
+            )
+        )
+
+        self.listener.add_new_user(connection_id, needs_follower_sync=is_new)
+        self.on_registered(connection_id, user.screen_name)
+
+
+def bulk_import(storage, entries, chunk_size=BULK_IMPORT_CHUNK_SIZE):
+    """
+    Register an iterable of (connection_id, token, token_secret[, app_index])
+    entries.
+
+    The new connections are left with a pending follower sync, which is how a
+    running bridge picks them up.
+
+    The entries are written in chunks, each on its own transaction. A chunk
+    that fails is logged and skipped, the import goes on with the next one.
+    As registrations are idempotent, the import can be run again to retry
+    them. Returns the number of newly registered connections and the number
+    of entries on failed chunks.
+    """
+    imported = 0
+    failed = 0
+    chunk = []
+    position = 0
+
+    def flush():
+        try:
+            registered = storage.bulk_register_users(chunk)
+        except Exception:
+            logging.error(
+                "Importing entries {start}-{end} \n{error}".format(
+                    start=position - len(chunk) + 1,
+                    end=position,
+                    error=traceback.format_exc(),
+                )
+            )
+            return 0, len(chunk)
+
+        logging.info(
+            "Imported {} new connections ({} entries)".format(
+                len(registered), len(chunk)
+            )
+        )
+        return len(registered), 0
+
+    for entry in entries:
+        chunk.append(entry)
+        position += 1
+        if len(chunk) >= chunk_size:
+            new, errors = flush()
+            imported, failed = imported + new, failed + errors
+            chunk = []
+
+    if len(chunk) > 0:
+        new, errors = flush()
+        imported, failed = imported + new, failed + errors
+
+    return imported, failed
@@ -0,0 +1,335 @@
+import concurrent.futures
+import functools
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import traceback
+import zlib
+
+RECORD_PATH_ENV = "TWITTER_BRIDGE_RECORD_PATH"
+FAKE_LATENCY_ENV = "TWITTER_BRIDGE_FAKE_LATENCY"  # Seconds per fake Twitter call
+REPLAY_WORKERS = 16  # Concurrent calls when replaying a log
+FAKE_FOLLOWERS_PER_USER = 100
+PERCENTILES = (50, 90, 99)
+
+
+def get_fake_latency():
+    return float(os.getenv(FAKE_LATENCY_ENV, "0"))
+
+
+def scratch_database():
+    directory = tempfile.mkdtemp(prefix="twitter-bridge-replay-")
+    return "sqlite:///{}".format(os.path.join(directory, "db.sqlite3"))
+
+
+class ReplayExtraData:
+    def __init__(self, user_id):
+        self.user_id = user_id
+
+
+def fake_tweet(tweet_id, screen_name):
+    return {
+        "id": tweet_id,
+        "text": "Tweet {} by {} #replay".format(tweet_id, screen_name),
+        "user": {"id": zlib.crc32(screen_name.encode()), "screen_name": screen_name},
+        "entities": {"hashtags": [{"text": "replay"}], "media": []},
+    }
+
+
+def record_argument(argument):
+    # Tweet structs are logged by reference, without their content or the
+    # author's profile. They are rebuilt with `fake_tweet` on replay.
+    if isinstance(argument, dict) and "id" in argument and "user" in argument:
+        return {
+            "tweet_id": argument["id"],
+            "screen_name": argument["user"].get("screen_name", None),
+        }
+    return argument
+
+
+def replay_argument(argument):
+    if isinstance(argument, dict) and "tweet_id" in argument:
+        return fake_tweet(argument["tweet_id"], argument["screen_name"] or "replay")
+    return argument
+
+
+class Recorder:
+    """
+    Keeps the bridge handlers by block, and appends every call to them to a
+    JSONL log if a `path` is given. Nothing is written until `start` is
+    called, so only a running bridge records.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.handlers = {}  # (type, block) -> unwrapped handler
+        self.lock = threading.Lock()
+        self.file = None
+
+    def start(self):
+        if self.path is not None:
+            self.file = open(self.path, "at")
+
+    @classmethod
+    def from_env(cls):
+        return cls(os.getenv(RECORD_PATH_ENV, None))
+
+    def record(self, call_type, block, user_id, arguments):
+        line = json.dumps(
+            dict(
+                time=time.time(),
+                type=call_type,
+                block=block,
+                user_id=user_id,
+                arguments=[record_argument(argument) for argument in arguments],
+            )
+        )
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write(line + "\n")
+            self.file.flush()
+
+    def block(self, call_type, block):
+        """
+        Decorator for a getter or operation handler.
+        """
+
+        def decorator(func):
+            self.handlers[(call_type, block)] = func
+            if self.path is None:
+                return func
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if "extra_data" in kwargs or len(args) == 0:
+                    extra_data, arguments = kwargs.get("extra_data", None), list(args)
+                else:
+                    extra_data, arguments = args[-1], list(args[:-1])
+                try:
+                    self.record(
+                        call_type,
+                        block,
+                        getattr(extra_data, "user_id", None),
+                        arguments,
+                    )
+                except Exception:
+                    logging.error(traceback.format_exc())
+                return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def getter(self, block):
+        return self.block("getter", block)
+
+    def operation(self, block):
+        return self.block("operation", block)
+
+    def listeners(self, event):
+        """
+        Decorator for the new listener handler of an event.
+        """
+
+        def decorator(func):
+            self.handlers[("listeners", event)] = func
+            if self.path is None:
+                return func
+
+            @functools.wraps(func)
+            def wrapper(user, subkey):
+                try:
+                    self.record("listeners", event, user, [subkey])
+                except Exception:
+                    logging.error(traceback.format_exc())
+                return func(user, subkey)
+
+            return wrapper
+
+        return decorator
+
+
+class FakeUser:
+    def __init__(self, user_id, screen_name):
+        self.id = user_id
+        self.screen_name = screen_name
+
+
+class FakeTwitterAPI:
+    """
+    Stands for a tweepy API on the calls done by the bridge, answering with
+    generated data after `latency` seconds.
+    """
+
+    def __init__(self, screen_name, raw_json, latency):
+        self.screen_name = screen_name
+        self.raw_json = raw_json
+        self.latency = latency
+
+    def _wait(self):
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def _latest_tweet_id(self):
+        # A new tweet every second
+        return int(time.time())
+
+    def user_timeline(self, screen_name, count=20):
+        self._wait()
+        latest = self._latest_tweet_id()
+        return [fake_tweet(latest - i, screen_name) for i in range(count)]
+
+    def home_timeline(self, since_id=None):
+        self._wait()
+        latest = self._latest_tweet_id()
+        oldest = latest - 20 if since_id is None else max(since_id, latest - 20)
+        return [
+            fake_tweet(tweet_id, "followed_{}".format(tweet_id % 10))
+            for tweet_id in range(latest, oldest, -1)
+        ]
+
+    def verify_credentials(self):
+        self._wait()
+        return {
+            "screen_name": self.screen_name,
+            "followers_count": FAKE_FOLLOWERS_PER_USER,
+        }
+
+    def followers_ids(self, screen_name=None):
+        self._wait()
+        return list(range(FAKE_FOLLOWERS_PER_USER))
+
+    def get_user(self, user_id=None, screen_name=None):
+        self._wait()
+        if screen_name is None:
+            screen_name = "user_{}".format(user_id)
+        user = FakeUser(
+            zlib.crc32(screen_name.encode()) % FAKE_FOLLOWERS_PER_USER, screen_name
+        )
+        if self.raw_json:
+            return {"id": user.id, "screen_name": user.screen_name}
+        return user
+
+    def create_friendship(self, screen_name):
+        self._wait()
+
+    def destroy_friendship(self, screen_name):
+        self._wait()
+
+
+class FakeAuthHandler:
+    """
+    Drop-in for `auth.AuthHandler` which never reaches Twitter.
+    """
+
+    def __init__(self, rate_limit_manager, latency=0):
+        self.rate_limit_manager = rate_limit_manager
+        self.latency = latency
+
+    def get_api(self, connection_id, raw_json=False):
+        return FakeTwitterAPI("replay_{}".format(connection_id), raw_json, self.latency)
+
+    def get_app_api(self, endpoint):
+        if self.rate_limit_manager.reserve_app_call([0], endpoint) is None:
+            return None
+        return FakeTwitterAPI("replay_app", True, self.latency)
+
+
+def read_log(path):
+    with open(path, "rt") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def replay(path, handlers, storage, speed=1.0, workers=REPLAY_WORKERS):
+    """
+    Call the `handlers` (as collected by a `Recorder`) with the calls on the
+    log at `path`, keeping their timing relative to the first call, divided
+    by `speed`.
+
+    Returns a dictionary of block -> list of latencies, in seconds. They are
+    measured since the call was due, so the time waiting for a free worker
+    is included.
+    """
+    latencies = {}
+    latencies_lock = threading.Lock()
+
+    # Replayed users get placeholder tokens on the replay database. This is
+    # done before starting, so it doesn't delay the replayed calls.
+    known_users = set()
+    for entry in read_log(path):
+        user_id = entry["user_id"]
+        if user_id is not None and user_id not in known_users:
+            storage.register_user(
+                user_id,
+                ("replay-{}".format(user_id), "replay-secret-{}".format(user_id)),
+            )
+            known_users.add(user_id)
+
+    def run(entry, due):
+        handler = handlers[(entry["type"], entry["block"])]
+        try:
+            if entry["type"] == "listeners":
+                handler(entry["user_id"], *entry["arguments"])
+            else:
+                arguments = map(replay_argument, entry["arguments"])
+                handler(*arguments, extra_data=ReplayExtraData(entry["user_id"]))
+        except Exception:
+            logging.error(
+                "Replaying {block} \n{error}".format(
+                    block=entry["block"], error=traceback.format_exc()
+                )
+            )
+        elapsed = time.time() - due
+        with latencies_lock:
+            latencies.setdefault(entry["block"], []).append(elapsed)
+
+    start = time.time()
+    first_call = None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for entry in read_log(path):
+            if first_call is None:
+                first_call = entry["time"]
+
+            # Entries behind the previous ones (e.g. after a clock change)
+            # are due right away.
+            due = start + max(0, entry["time"] - first_call) / speed
+            wait = due - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            executor.submit(run, entry, due)
+
+    return latencies
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def format_report(latencies):
+    lines = [
+        "{:<32} {:>8} {}".format(
+            "Block",
+            "Calls",
+            " ".join("{:>9}".format("p{}".format(p)) for p in PERCENTILES),
+        )
+    ]
+    for block, values in sorted(latencies.items()):
+        lines.append(
+            "{:<32} {:>8} {}".format(
+                block,
+                len(values),
+                " ".join(
+                    "{:>7.1f}ms".format(percentile(values, p) * 1000)
+                    for p in PERCENTILES
+                ),
+            )
+        )
+    return "\n".join(lines)
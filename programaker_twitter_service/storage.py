@@ -1,6 +1,8 @@
 import logging
 import os
 import re
+import threading
+import time
 
 import sqlalchemy
 from xdg import XDG_DATA_HOME
@@ -36,61 +38,148 @@ class EngineContext:
 
 
 class StorageEngine:
-    def __init__(self, engine):
+    def __init__(self, engine=None, engine_factory=None, on_engine_created=None):
+        assert (engine is not None) or (engine_factory is not None)
         self.engine = engine
+        self.engine_factory = engine_factory
+        self.on_engine_created = on_engine_created
+        self.engine_lock = threading.Lock()
+
+    def _get_engine(self):
+        # The engine is created on first use, this way the database driver is
+        # not loaded until something is actually needed from it.
+        if self.engine is None:
+            with self.engine_lock:
+                if self.engine is None:
+                    start = time.time()
+                    self.engine = self.engine_factory()
+                    if self.on_engine_created is not None:
+                        self.on_engine_created(time.time() - start)
+        return self.engine
 
     def _connect_db(self):
-        return EngineContext(self.engine)
+        return EngineContext(self._get_engine())
 
-    def register_user(self, connection_id, token_info, in_add_transaction=None):
-        with self._connect_db() as conn:
-            access_token, access_token_secret = token_info
+    def register_user(self, connection_id, token_info, app_index=0):
+        access_token, access_token_secret = token_info
 
-            # Create tweeter user
-            check = conn.execute(
-                sqlalchemy.select([models.TwitterUserRegistration.c.id]).where(
-                    models.TwitterUserRegistration.c.twitter_token == access_token
+        with self._connect_db() as conn:
+            with conn.begin():
+                return self._register_user(
+                    conn, connection_id, access_token, access_token_secret, app_index
                 )
-            ).fetchone()
 
-            if check is None:
-                op = models.TwitterUserRegistration.insert().values(
-                    twitter_token=access_token, twitter_token_secret=access_token_secret
-                )
-                result = conn.execute(op)
-                twitter_user_id = result.inserted_primary_key[0]
-            else:
-                twitter_user_id = check.id
+    def _insert_ignore(self, conn, table, **values):
+        """
+        Insert a row unless it conflicts with an existing one. Returns the
+        number of inserted rows.
+        """
+        dialect = conn.dialect.name
+        if dialect == "postgresql":
+            from sqlalchemy.dialects import postgresql
+
+            op = postgresql.insert(table).values(**values).on_conflict_do_nothing()
+        elif dialect == "sqlite":
+            op = table.insert().prefix_with("OR IGNORE").values(**values)
+        elif dialect == "mysql":
+            op = table.insert().prefix_with("IGNORE").values(**values)
+        else:
+            savepoint = conn.begin_nested()
+            try:
+                result = conn.execute(table.insert().values(**values))
+            except sqlalchemy.exc.IntegrityError:
+                savepoint.rollback()
+                return 0
+            savepoint.commit()
+            return result.rowcount
+
+        return conn.execute(op).rowcount
+
+    def _register_user(
+        self, conn, connection_id, access_token, access_token_secret, app_index
+    ):
+        # Inserts are done as insert-or-ignore, so concurrent registrations
+        # of the same token (e.g. a bulk import while the bridge is running)
+        # don't fail on the unique constraints.
+        self._insert_ignore(
+            conn,
+            models.TwitterUserRegistration,
+            twitter_token=access_token,
+            twitter_token_secret=access_token_secret,
+        )
 
-            # Create programaker user
-            check = conn.execute(
-                sqlalchemy.select([models.PlazaUsers.c.id]).where(
-                    models.PlazaUsers.c.id == connection_id
+        # Find the twitter user and the programaker user bound to it, if any
+        check = conn.execute(
+            sqlalchemy.select(
+                [
+                    models.TwitterUserRegistration.c.id,
+                    models.PlazaUsersInTwitter.c.plaza_id,
+                ]
+            )
+            .select_from(
+                sqlalchemy.outerjoin(
+                    models.TwitterUserRegistration,
+                    models.PlazaUsersInTwitter,
+                    models.TwitterUserRegistration.c.id
+                    == models.PlazaUsersInTwitter.c.twitter_id,
                 )
-            ).fetchone()
+            )
+            .where(models.TwitterUserRegistration.c.twitter_token == access_token)
+        ).fetchone()
 
-            if check is None:
-                insert = models.PlazaUsers.insert().values(id=connection_id)
-                conn.execute(insert)
+        if check is None:
+            raise Exception("Token secret already registered with a different token")
 
-            # Bind the two users
-            check = conn.execute(
-                sqlalchemy.select([models.PlazaUsersInTwitter.c.twitter_id]).where(
-                    models.PlazaUsersInTwitter.c.twitter_id == twitter_user_id
-                )
-            ).fetchone()
+        if check.plaza_id is not None:
+            # Already bound
+            return False
 
-            if check is None:
-                if in_add_transaction is not None:
-                    in_add_transaction(conn, twitter_user_id)
+        twitter_user_id = check.id
 
-                insert = models.PlazaUsersInTwitter.insert().values(
-                    plaza_id=connection_id, twitter_id=twitter_user_id
-                )
-                conn.execute(insert)
-                return True
-            else:
-                return False
+        # The access token is only valid for the app that requested it
+        self._insert_ignore(
+            conn, models.TwitterUserApp, twitter_id=twitter_user_id, app_index=app_index
+        )
+        self._insert_ignore(conn, models.PlazaUsers, id=connection_id)
+
+        # Bind the two users. The initial follower list is loaded later by the
+        # listener, so registration doesn't wait for the Twitter API.
+        bound = self._insert_ignore(
+            conn,
+            models.PlazaUsersInTwitter,
+            plaza_id=connection_id,
+            twitter_id=twitter_user_id,
+        )
+        if bound == 0:
+            return False
+
+        self._insert_ignore(
+            conn, models.PendingFollowerSync, twitter_id=twitter_user_id
+        )
+        return True
+
+    def bulk_register_users(self, entries):
+        """
+        Register a batch of (connection_id, token, token_secret[, app_index])
+        entries on a single transaction. Returns the connection IDs that were
+        newly bound.
+        """
+        registered = []
+        with self._connect_db() as conn:
+            with conn.begin():
+                for entry in entries:
+                    connection_id, access_token, access_token_secret = entry[:3]
+                    app_index = int(entry[3]) if len(entry) > 3 else 0
+                    if self._register_user(
+                        conn,
+                        connection_id,
+                        access_token,
+                        access_token_secret,
+                        app_index,
+                    ):
+                        registered.append(connection_id)
+
+        return registered
 
     def get_consumer_key(self, connection_id):
         with self._connect_db() as conn:
@@ -99,6 +188,10 @@ class StorageEngine:
                 models.PlazaUsersInTwitter,
                 models.TwitterUserRegistration.c.id
                 == models.PlazaUsersInTwitter.c.twitter_id,
+            ).outerjoin(
+                models.TwitterUserApp,
+                models.TwitterUserRegistration.c.id
+                == models.TwitterUserApp.c.twitter_id,
             )
 
             results = conn.execute(
@@ -106,13 +199,17 @@ class StorageEngine:
                     [
                         models.TwitterUserRegistration.c.twitter_token,
                         models.TwitterUserRegistration.c.twitter_token_secret,
+                        models.TwitterUserApp.c.app_index,
                     ]
                 )
                 .select_from(join)
                 .where(models.PlazaUsersInTwitter.c.plaza_id == connection_id)
             ).fetchall()
 
-            return [dict(zip(["token", "token_secret"], row)) for row in results]
+            return [
+                dict(token=token, token_secret=token_secret, app=app_index or 0)
+                for token, token_secret, app_index in results
+            ]
 
     def get_last_tweet_by_user(self, user_id, channel):
         with self._connect_db() as conn:
@@ -228,14 +325,43 @@ class StorageEngine:
 
             return result is not None
 
-    def _initialize_followers(self, conn, twitter_id, followers):
-        conn.execute(
-            models.TwitterFollows.insert(),
-            [
-                dict(followed_id=twitter_id, follower_id=follower,)
-                for follower in followers
-            ],
-        )
+    def get_pending_follower_syncs(self):
+        """
+        Returns the users whose follower list has not been loaded yet.
+        """
+        with self._connect_db() as conn:
+            join = sqlalchemy.join(
+                models.PendingFollowerSync,
+                models.PlazaUsersInTwitter,
+                models.PendingFollowerSync.c.twitter_id
+                == models.PlazaUsersInTwitter.c.twitter_id,
+            )
+            results = conn.execute(
+                sqlalchemy.select([models.PlazaUsersInTwitter.c.plaza_id]).select_from(
+                    join
+                )
+            ).fetchall()
+
+            return map(lambda x: x.plaza_id, results)
+
+    def initialize_followers(self, twitter_id, followers):
+        with self._connect_db() as conn:
+            with conn.begin():
+                followers = list(followers)
+                if len(followers) > 0:
+                    conn.execute(
+                        models.TwitterFollows.insert(),
+                        [
+                            dict(followed_id=twitter_id, follower_id=follower,)
+                            for follower in followers
+                        ],
+                    )
+
+                conn.execute(
+                    models.PendingFollowerSync.delete().where(
+                        models.PendingFollowerSync.c.twitter_id == twitter_id
+                    )
+                )
 
     def get_all_users(self):
         with self._connect_db() as conn:
@@ -247,6 +373,35 @@ class StorageEngine:
 
             return map(lambda x: x.plaza_id, results)
 
+    def iter_user_chunks(self, chunk_size):
+        """
+        Yield the registered users in lists of up to `chunk_size` elements.
+
+        Each chunk is read on its own connection, so no connection is kept
+        open between chunks.
+        """
+        last_id = None
+        while True:
+            with self._connect_db() as conn:
+                query = sqlalchemy.select([models.PlazaUsersInTwitter.c.plaza_id])
+                if last_id is not None:
+                    query = query.where(models.PlazaUsersInTwitter.c.plaza_id > last_id)
+
+                results = conn.execute(
+                    query.order_by(models.PlazaUsersInTwitter.c.plaza_id).limit(
+                        chunk_size
+                    )
+                ).fetchall()
+
+            if len(results) == 0:
+                return
+
+            chunk = [row.plaza_id for row in results]
+            yield chunk
+            if len(chunk) < chunk_size:
+                return
+            last_id = chunk[-1]
+
     def add_follower(self, twitter_id, follower_id):
         with self._connect_db() as conn:
             op = models.TwitterFollows.insert().values(
@@ -267,14 +422,24 @@ class StorageEngine:
             conn.execute(op)
 
 
-def get_engine():
+def _create_engine(connection_string=CONNECTION_STRING):
     # Create path to SQLite file, if its needed.
-    if CONNECTION_STRING.startswith("sqlite"):
-        db_file = re.sub("sqlite.*:///", "", CONNECTION_STRING)
+    if connection_string.startswith("sqlite"):
+        db_file = re.sub("sqlite.*:///", "", connection_string)
         os.makedirs(os.path.dirname(db_file), exist_ok=True)
 
-    engine = sqlalchemy.create_engine(CONNECTION_STRING)
+    engine = sqlalchemy.create_engine(connection_string)
     metadata = models.metadata
     metadata.create_all(engine)
 
-    return StorageEngine(engine)
+    return engine
+
+
+def get_engine(lazy=False, connection_string=CONNECTION_STRING, on_engine_created=None):
+    if lazy:
+        return StorageEngine(
+            engine_factory=lambda: _create_engine(connection_string),
+            on_engine_created=on_engine_created,
+        )
+
+    return StorageEngine(_create_engine(connection_string))
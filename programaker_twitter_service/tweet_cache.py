@@ -0,0 +1,110 @@
+import collections
+import threading
+import time
+
+TWEET_CACHE_SIZE = 10000  # Maximum number of tweets kept in memory
+TWEET_CACHE_TTL = 5 * 60  # Seconds a cached tweet (or author's last tweet) is valid
+
+
+class TweetCache:
+    """
+    Short-lived, size-bounded cache of tweets, shared by all the users.
+
+    Tweets are kept as the JSON dictionaries sent to PrograMaker, so a tweet
+    that appears on the timeline of several users is only stored once.
+
+    Only tweets read without any user's credentials are shared. The ones read
+    with a user's tokens carry fields that depend on the reader (`favorited`,
+    `retweeted`, `current_user_retweet`, `user.following`...).
+    """
+
+    def __init__(self, max_size=TWEET_CACHE_SIZE, ttl=TWEET_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.tweets = collections.OrderedDict()  # Id -> (timestamp, tweet)
+        self.latest_by_author = {}  # Lowercased screen name -> (timestamp, id)
+
+    def add(self, tweet):
+        """
+        Add a publicly read tweet to the cache and return the cached version
+        of it. Expired versions are replaced, so counts don't get stale.
+        """
+        tweet_id = tweet["id"]
+        now = time.time()
+        with self.lock:
+            entry = self.tweets.get(tweet_id, None)
+            if entry is not None:
+                self.tweets.move_to_end(tweet_id)
+                if now - entry[0] <= self.ttl:
+                    tweet = entry[1]
+                    now = entry[0]
+            self.tweets[tweet_id] = (now, tweet)
+
+            while len(self.tweets) > self.max_size:
+                self.tweets.popitem(last=False)
+
+        return tweet
+
+    def get(self, tweet_id):
+        with self.lock:
+            entry = self.tweets.get(tweet_id, None)
+            if entry is None:
+                return None
+
+            timestamp, tweet = entry
+            if time.time() - timestamp > self.ttl:
+                del self.tweets[tweet_id]
+                return None
+
+            return tweet
+
+    def add_timeline(self, screen_name, tweets, public=False):
+        """
+        Add the tweets from `screen_name`'s timeline (newest first), as
+        returned by `statuses/user_timeline`. Returns the cached versions.
+
+        Only `public` reads (done without any user's credentials) are cached
+        and offered as the author's latest tweet. A read with a user's tokens
+        can include tweets other users can't see (protected accounts or
+        blocks), and per-reader fields, so those are returned as they are.
+        """
+        if not public:
+            return list(tweets)
+
+        tweets = [self.add(tweet) for tweet in tweets]
+
+        protected = len(tweets) > 0 and tweets[0].get("user", {}).get(
+            "protected", False
+        )
+        if len(tweets) > 0 and not protected:
+            with self.lock:
+                self.latest_by_author[screen_name.lower()] = (
+                    time.time(),
+                    tweets[0]["id"],
+                )
+
+                # Keep the index from outgrowing the tweets it points to
+                if len(self.latest_by_author) > self.max_size:
+                    self._evict_expired_authors()
+
+        return tweets
+
+    def get_latest_by_author(self, screen_name):
+        with self.lock:
+            entry = self.latest_by_author.get(screen_name.lower(), None)
+
+        if entry is None:
+            return None
+
+        timestamp, tweet_id = entry
+        if time.time() - timestamp > self.ttl:
+            return None
+
+        return self.get(tweet_id)
+
+    def _evict_expired_authors(self):
+        limit = time.time() - self.ttl
+        for screen_name, (timestamp, _) in list(self.latest_by_author.items()):
+            if timestamp < limit:
+                del self.latest_by_author[screen_name]
@@ -1,5 +1,48 @@
+import logging
+import threading
+import time
+
+
 def ws_endpoint_to_callback_url(ws_endpoint):
     assert ws_endpoint.startswith("ws")
     assert ws_endpoint.endswith("communication")
     rest_root = ws_endpoint[: -len("communication")].replace("ws", "http", 1)
     return rest_root + "oauth_return"
+
+
+class StartupTimer:
+    """
+    Records how long each startup stage took. Stages can be marked from any
+    thread, the ones marked after `report` are logged right away.
+    """
+
+    def __init__(self, start=None):
+        self.start = start if start is not None else time.time()
+        self.last = self.start
+        self.stages = []
+        self.reported = False
+        self.lock = threading.Lock()
+
+    def mark(self, stage, elapsed=None):
+        """
+        Mark the end of `stage`. If `elapsed` is not given, the stage is
+        considered to span since the previous mark.
+        """
+        with self.lock:
+            now = time.time()
+            if elapsed is None:
+                elapsed = now - self.last
+                self.last = now
+            self.stages.append((stage, elapsed, now - self.start))
+
+            if self.reported:
+                self._log_stage(stage, elapsed, now - self.start)
+
+    def report(self):
+        with self.lock:
+            for stage, elapsed, at in self.stages:
+                self._log_stage(stage, elapsed, at)
+            self.reported = True
+
+    def _log_stage(self, stage, elapsed, at):
+        logging.info("Startup {}: {:.3f}s (at {:.3f}s)".format(stage, elapsed, at))
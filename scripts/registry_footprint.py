@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Measure the memory used by the listener's subscription registry and the
+rate limit usage records, compared with the previous layout (a set of
+channels per user and nested dictionaries per connection and endpoint).
+
+Usage: registry_footprint.py [users] [channels per user]
+"""
+
+import logging
+import sys
+import time
+import tracemalloc
+
+from programaker_twitter_service import listener, rate_limit
+
+NUM_USERS = 20000
+CHANNELS_PER_USER = 5
+NUM_ACCOUNTS = 5000  # Distinct accounts listened to, shared between users
+
+
+def channel_name(user_index, channel_index):
+    # Built on each call, as it would come from a separate message
+    return "account_{}".format((user_index * 7 + channel_index) % NUM_ACCOUNTS)
+
+
+def user_name(user_index):
+    return "{:036d}".format(user_index)
+
+
+def measure_legacy(num_users, channels_per_user):
+    tracemalloc.start()
+    by_user = {}
+    usage_info = {}
+
+    def check(connection_id, endpoint, element=None):
+        connection_usage = usage_info.setdefault(connection_id, {})
+        endpoint_usage = connection_usage.setdefault(
+            endpoint, {"active": None, "check": {}}
+        )
+        endpoint_usage["check"][element] = time.time()
+
+    for user_index in range(num_users):
+        user = user_name(user_index)
+        for channel_index in range(channels_per_user):
+            by_user.setdefault(user, set()).add(channel_name(user_index, channel_index))
+
+        for channel in by_user[user]:
+            check(user, rate_limit.USER_TIMELINE, channel)
+        check(user, rate_limit.FOLLOWERS_IDS)
+        check(user, rate_limit.HOME_TIMELINE)
+
+    size, _peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size
+
+
+def measure_current(num_users, channels_per_user):
+    tracemalloc.start()
+    manager = rate_limit.RateLimitManager()
+    thread = listener.TweetListenerThread(None, manager, None)
+
+    for user_index in range(num_users):
+        user = user_name(user_index)
+        for channel_index in range(channels_per_user):
+            thread.add_to_user(user, channel_name(user_index, channel_index))
+
+        user = sys.intern(user)
+        channels = thread.by_user[user]
+        for channel in channels:
+            manager.time_for_periodic_check(
+                user, rate_limit.USER_TIMELINE, len(channels), channel
+            )
+        manager.time_for_periodic_check(user, rate_limit.FOLLOWERS_IDS, 1)
+        manager.time_for_periodic_check(user, rate_limit.HOME_TIMELINE, 1)
+
+    size, _peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size
+
+
+if __name__ == "__main__":
+    logging.disable(logging.CRITICAL)
+
+    num_users = int(sys.argv[1]) if len(sys.argv) > 1 else NUM_USERS
+    channels_per_user = int(sys.argv[2]) if len(sys.argv) > 2 else CHANNELS_PER_USER
+
+    print(
+        "{} users x {} channels ({} subscriptions)".format(
+            num_users, channels_per_user, num_users * channels_per_user
+        )
+    )
+    print(
+        "Previous layout: {:.1f}MB".format(
+            measure_legacy(num_users, channels_per_user) / 1e6
+        )
+    )
+    print(
+        "Current layout:  {:.1f}MB".format(
+            measure_current(num_users, channels_per_user) / 1e6
+        )
+    )